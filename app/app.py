@@ -1,9 +1,24 @@
-from flask import Flask, render_template, flash, request, redirect, url_for, session
+from flask import Flask, render_template, flash, request, redirect, url_for, session, g
+from flask_caching import Cache
 from flask_sqlalchemy import SQLAlchemy
 from werkzeug.security import generate_password_hash, check_password_hash
-import calendar
-from datetime import datetime, date, timedelta
-from sqlalchemy import func
+import orjson
+import sqlite3
+from datetime import datetime, date, timedelta, timezone
+from sqlalchemy import (
+    String,
+    TypeDecorator,
+    and_,
+    case,
+    event,
+    func,
+    literal,
+    or_,
+    select,
+    text,
+)
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.engine import Engine
 from zoneinfo import ZoneInfo
 import os
 from dotenv import load_dotenv
@@ -16,14 +31,49 @@ load_dotenv()
 # Get secret values
 FLASK_SECRET_KEY = os.getenv("FLASK_SECRET_KEY", "fallbacksecret")
 SECRET_REGISTRATION_CODE = os.getenv("REGISTRATION_CODE", "DEFAULTCODE")
+PASSWORD_HASH_METHOD = os.getenv("PASSWORD_HASH_METHOD", "scrypt:32768:8:1")
 
 app = Flask(__name__)
 app.secret_key = FLASK_SECRET_KEY
 app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///steps.db"
+app.config["CACHE_TYPE"] = "SimpleCache"
+app.config["CACHE_DEFAULT_TIMEOUT"] = 60
 db = SQLAlchemy(app)
+cache = Cache(app)
+
+
+@event.listens_for(Engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL lets leaderboard reads run alongside step reports; the larger page
+    # cache and mmap keep the step index resident
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.execute("PRAGMA cache_size=-65536")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
 
 
 # --- Models ---
+class ISODate(TypeDecorator):
+    """YYYY-MM-DD string column that also accepts date objects as parameters.
+
+    Binding a date keeps comparisons string-to-string, so SQLite can use the
+    (user_id, date) index instead of coercing every row.
+    """
+
+    impl = String
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if isinstance(value, date):
+            return value.isoformat()
+        return value
+
+
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(50), unique=True)
@@ -33,13 +83,33 @@ class User(db.Model):
 
 
 class Step(db.Model):
+    # One entry per user per day; lookups filter on user_id then range over date
+    __table_args__ = (db.Index("uq_step_user_date", "user_id", "date", unique=True),)
+
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey("user.id"))
-    date = db.Column(db.String(10))  # YYYY-MM-DD
+    date = db.Column(ISODate(10))  # YYYY-MM-DD
     steps = db.Column(db.Integer)
 
 
+class UserMonthlySummary(db.Model):
+    # Leaderboard totals per user, valid for the day stored in as_of
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), primary_key=True)
+    as_of = db.Column(ISODate(10))  # YYYY-MM-DD
+    day_total = db.Column(db.Integer, default=0)
+    week_total = db.Column(db.Integer, default=0)
+    month_total = db.Column(db.Integer, default=0, index=True)
+    last_updated = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+
+
 # --- Routes ---
+@app.before_request
+def set_today():
+    # Read the Sydney clock once so a request straddling midnight stays consistent
+    g.today = datetime.now(SYDNEY_TZ).date()
+    g.today_iso = g.today.isoformat()
+
+
 @app.route("/")
 def index():
     return redirect(url_for("leaderboard"))
@@ -67,10 +137,11 @@ def register():
             return redirect(url_for("register"))
 
         # Create new user
-        hashed_password = generate_password_hash(password)
+        hashed_password = generate_password_hash(password, method=PASSWORD_HASH_METHOD)
         new_user = User(username=username, password_hash=hashed_password)
         db.session.add(new_user)
         db.session.commit()
+        _invalidate_leaderboard()
 
         flash("Registration successful! You can now log in.", "success")
         return redirect(url_for("login"))
@@ -84,10 +155,10 @@ def dashboard():
         return redirect(url_for("login"))
 
     user_id = session["user_id"]
-    user = User.query.get(user_id)
+    username = db.session.query(User.username).filter(User.id == user_id).scalar()
 
     # --- Date setup ---
-    today = datetime.now().date()
+    today = g.today
     september_start = datetime(today.year, 9, 1).date()
     september_end = datetime(today.year, 9, 30).date()
 
@@ -108,30 +179,38 @@ def dashboard():
     week_end = min(week_start + timedelta(days=6), september_end)
 
     # --- Query data for dashboard ---
-    # 1. Today's steps
-    today_steps = (
-        db.session.query(func.sum(Step.steps))
-        .filter(Step.user_id == user_id, Step.date == today)
-        .scalar()
-        or 0
-    )
-
-    # 2. Week's steps
-    week_steps = (
-        db.session.query(func.sum(Step.steps))
-        .filter(Step.user_id == user_id, Step.date.between(week_start, week_end))
-        .scalar()
-        or 0
-    )
-
-    # 3. Month's steps
-    month_steps = (
-        db.session.query(func.sum(Step.steps))
+    # Today's, week's and month's steps in one pass over September's rows
+    today_iso = g.today_iso
+    week_start_iso = week_start.isoformat()
+    week_end_iso = week_end.isoformat()
+    month_start_iso = september_start.isoformat()
+    next_month_iso = (september_end + timedelta(days=1)).isoformat()
+
+    today_steps, week_steps, month_steps = (
+        db.session.query(
+            func.coalesce(
+                func.sum(case((Step.date == today_iso, Step.steps), else_=0)), 0
+            ),
+            func.coalesce(
+                func.sum(
+                    case(
+                        (
+                            and_(Step.date >= week_start_iso, Step.date <= week_end_iso),
+                            Step.steps,
+                        ),
+                        else_=0,
+                    )
+                ),
+                0,
+            ),
+            func.coalesce(func.sum(Step.steps), 0),
+        )
         .filter(
-            Step.user_id == user_id, Step.date.between(september_start, september_end)
+            Step.user_id == user_id,
+            Step.date >= month_start_iso,
+            Step.date < next_month_iso,
         )
-        .scalar()
-        or 0
+        .one()
     )
 
     # --- Progress percentages ---
@@ -140,24 +219,29 @@ def dashboard():
     monthly_percent = min(int((month_steps / 450000) * 100), 100)
 
     # --- Weekly data for chart ---
+    daily_totals = dict(
+        db.session.query(Step.date, func.sum(Step.steps))
+        .filter(
+            Step.user_id == user_id,
+            Step.date >= week_start_iso,
+            Step.date <= week_end_iso,
+        )
+        .group_by(Step.date)
+        .all()
+    )
+
     labels = []
     chart_data = []
     current_day = week_start
 
     while current_day <= week_end:
-        steps_for_day = (
-            db.session.query(func.sum(Step.steps))
-            .filter(Step.user_id == user_id, Step.date == current_day)
-            .scalar()
-            or 0
-        )
         labels.append(current_day.strftime("%a %d"))
-        chart_data.append(steps_for_day)
+        chart_data.append(daily_totals.get(current_day.isoformat(), 0))
         current_day += timedelta(days=1)
 
     return render_template(
         "dashboard.html",
-        username=user.username,
+        username=username,
         today=today,
         week_start=week_start,
         week_end=week_end,
@@ -192,6 +276,17 @@ def login():
                 error="This account has been locked. Please contact the administrator.",
             )
 
+        # Upgrade hashes created with another method now that we have the password.
+        # Werkzeug expands bare methods ("scrypt" -> "scrypt:32768:8:1"), so only
+        # the parts spelled out in PASSWORD_HASH_METHOD are compared
+        configured = PASSWORD_HASH_METHOD.split(":")
+        stored = user.password_hash.split("$", 1)[0].split(":")
+        if stored[: len(configured)] != configured:
+            user.password_hash = generate_password_hash(
+                password, method=PASSWORD_HASH_METHOD
+            )
+            db.session.commit()
+
         # login success
         session["user_id"] = user.id
         session["username"] = user.username
@@ -211,14 +306,14 @@ def report():
     if "user_id" not in session:
         return redirect(url_for("login"))
 
-    today_sydney = datetime.now(SYDNEY_TZ).date()
+    today_sydney = g.today
     september_start = date(today_sydney.year, 9, 1)
     september_end = date(today_sydney.year, 9, 30)
 
     if request.method == "POST":
         try:
             step_count = int(request.form["steps"])
-            report_date_str = request.form.get("date", today_sydney.isoformat())
+            report_date_str = request.form.get("date", g.today_iso)
             report_date = datetime.fromisoformat(report_date_str).date()
 
             # Validate date
@@ -227,22 +322,23 @@ def report():
             if report_date < september_start or report_date > september_end:
                 return "Can only report steps for September.", 400
 
-            # Check if entry exists
-            existing = Step.query.filter_by(
-                user_id=session["user_id"], date=report_date.isoformat()
-            ).first()
-
-            if existing:
-                existing.steps = step_count
-            else:
-                new_step = Step(
-                    user_id=session["user_id"],
-                    date=report_date.isoformat(),
-                    steps=step_count,
-                )
-                db.session.add(new_step)
+            # Insert the entry, or replace the steps already reported that day
+            stmt = insert(Step).values(
+                user_id=session["user_id"],
+                date=report_date.isoformat(),
+                steps=step_count,
+            )
+            stmt = stmt.on_conflict_do_update(
+                index_elements=["user_id", "date"],
+                set_=dict(steps=stmt.excluded.steps),
+            )
+            db.session.execute(stmt)
 
+            # Update this user's leaderboard totals in the same transaction
+            _refresh_summaries(*_leaderboard_period(), [session["user_id"]])
             db.session.commit()
+            # Make the new entry visible on the leaderboard straight away
+            _invalidate_leaderboard()
             return redirect(url_for("dashboard"))
 
         except ValueError:
@@ -251,63 +347,119 @@ def report():
     return render_template("report.html", today=today_sydney)
 
 
-@app.route("/leaderboard")
-def leaderboard():
-    # Force September 2025 challenge period
-    start_date = datetime(2025, 9, 1).date()
-    end_date = datetime(2025, 9, 30).date()
+def _refresh_summaries(start_date, end_date, today, user_ids):
+    start_week = max(start_date, today - timedelta(days=6))
+
+    today_iso = today.isoformat()
+    start_week_iso = start_week.isoformat()
+    start_iso = start_date.isoformat()
+    next_month_iso = (end_date + timedelta(days=1)).isoformat()
+
+    # Daily, weekly and monthly totals for the given users, written in the same
+    # INSERT ... SELECT so a concurrent report can't land between read and write
+    totals = (
+        select(
+            User.id,
+            literal(today_iso, ISODate(10)),
+            func.coalesce(
+                func.sum(case((Step.date == today_iso, Step.steps), else_=0)), 0
+            ),
+            func.coalesce(
+                func.sum(
+                    case(
+                        (
+                            and_(Step.date >= start_week_iso, Step.date <= today_iso),
+                            Step.steps,
+                        ),
+                        else_=0,
+                    )
+                ),
+                0,
+            ),
+            func.coalesce(
+                func.sum(
+                    case(
+                        (
+                            and_(Step.date >= start_iso, Step.date < next_month_iso),
+                            Step.steps,
+                        ),
+                        else_=0,
+                    )
+                ),
+                0,
+            ),
+            literal(datetime.now(timezone.utc), db.DateTime),
+        )
+        .outerjoin(Step, Step.user_id == User.id)
+        # SQLite needs a WHERE here to parse ON CONFLICT after a join
+        .where(User.id.in_(user_ids))
+        .group_by(User.id)
+    )
+
+    stmt = insert(UserMonthlySummary).from_select(
+        ["user_id", "as_of", "day_total", "week_total", "month_total", "last_updated"],
+        totals,
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["user_id"],
+        set_=dict(
+            as_of=stmt.excluded.as_of,
+            day_total=stmt.excluded.day_total,
+            week_total=stmt.excluded.week_total,
+            month_total=stmt.excluded.month_total,
+            last_updated=stmt.excluded.last_updated,
+        ),
+    )
+    db.session.execute(stmt)
+
 
+@cache.memoize()
+def _compute_leaderboard(start_date, end_date, today):
     daily_goal = 15000
     days_in_month = (end_date - start_date).days + 1
     weekly_goal = daily_goal * 7
     monthly_goal = daily_goal * days_in_month
 
-    today = datetime.now(SYDNEY_TZ).date()
-    # Clamp today to end_date if we're past September
-    if today > end_date:
-        today = end_date
+    # Summaries go stale when the day rolls over; new users have none yet
+    stale_ids = [
+        user_id
+        for (user_id,) in db.session.query(User.id)
+        .outerjoin(UserMonthlySummary, UserMonthlySummary.user_id == User.id)
+        .filter(
+            or_(
+                UserMonthlySummary.user_id.is_(None),
+                UserMonthlySummary.as_of != today.isoformat(),
+            )
+        )
+        .all()
+    ]
+    if stale_ids:
+        _refresh_summaries(start_date, end_date, today, stale_ids)
+        db.session.commit()
 
-    start_week = max(start_date, today - timedelta(days=6))
+    rows = (
+        db.session.query(
+            User.username,
+            UserMonthlySummary.day_total,
+            UserMonthlySummary.week_total,
+            UserMonthlySummary.month_total,
+        )
+        .join(UserMonthlySummary, UserMonthlySummary.user_id == User.id)
+        .order_by(UserMonthlySummary.month_total.desc(), User.id)
+        .limit(100)
+        .all()
+    )
 
-    users = User.query.all()
     leaderboard_data = []
 
-    for u in users:
-        # Daily (but only if within Sept range)
-        today_steps = (
-            db.session.query(func.sum(Step.steps))
-            .filter(Step.user_id == u.id)
-            .filter(Step.date == today.isoformat())
-            .scalar()
-            or 0
-        )
+    for username, today_steps, week_steps, month_steps in rows:
         daily_percent = min(int(today_steps / daily_goal * 100), 100)
-
-        # Weekly (bounded inside September)
-        week_steps = (
-            db.session.query(func.sum(Step.steps))
-            .filter(Step.user_id == u.id)
-            .filter(Step.date >= start_week.isoformat(), Step.date <= today.isoformat())
-            .scalar()
-            or 0
-        )
         weekly_percent = min(int(week_steps / weekly_goal * 100), 100)
-
-        # Monthly (strictly 1–30 Sept)
-        month_steps = (
-            db.session.query(func.sum(Step.steps))
-            .filter(Step.user_id == u.id)
-            .filter(
-                Step.date >= start_date.isoformat(), Step.date <= end_date.isoformat()
-            )
-            .scalar()
-            or 0
-        )
         monthly_percent = min(int(month_steps / monthly_goal * 100), 100)
 
         leaderboard_data.append(
             (
-                u.username,
+                username,
                 today_steps,
                 daily_percent,
                 week_steps,
@@ -317,10 +469,59 @@ def leaderboard():
             )
         )
 
-    leaderboard_data.sort(key=lambda x: x[5], reverse=True)
+    return leaderboard_data
+
+
+def _leaderboard_period():
+    # Force September 2025 challenge period
+    start_date = datetime(2025, 9, 1).date()
+    end_date = datetime(2025, 9, 30).date()
+
+    today = g.today
+    # Clamp today to end_date if we're past September
+    if today > end_date:
+        today = end_date
+
+    return start_date, end_date, today
+
+
+@cache.memoize()
+def _leaderboard_json(start_date, end_date, today):
+    columns = (
+        "user",
+        "today_steps",
+        "daily_percent",
+        "week_steps",
+        "weekly_percent",
+        "month_steps",
+        "monthly_percent",
+    )
+    return orjson.dumps(
+        {
+            "month": "September",
+            "year": 2025,
+            "today": today,
+            "leaderboard": [
+                dict(zip(columns, row))
+                for row in _compute_leaderboard(start_date, end_date, today)
+            ],
+        }
+    )
+
+
+def _invalidate_leaderboard():
+    cache.delete_memoized(_compute_leaderboard)
+    cache.delete_memoized(_leaderboard_json)
+
+
+@app.route("/leaderboard")
+def leaderboard():
+    start_date, end_date, today = _leaderboard_period()
+
+    leaderboard_data = _compute_leaderboard(start_date, end_date, today)
 
     if not leaderboard_data:
-        leaderboard_data.append(("No users", 0, 0, 0, 0, 0, 0))
+        leaderboard_data = [("No users", 0, 0, 0, 0, 0, 0)]
 
     return render_template(
         "leaderboard.html",
@@ -331,7 +532,32 @@ def leaderboard():
     )
 
 
+@app.route("/leaderboard.json")
+def leaderboard_json():
+    body = _leaderboard_json(*_leaderboard_period())
+    return app.response_class(body, mimetype="application/json")
+
+
 if __name__ == "__main__":
     with app.app_context():
         db.create_all()
+        # Older databases may hold several entries for one user and day. The old
+        # report() always edited the first (lowest id) of them, so that row has
+        # the current value; drop the rest so the unique index below can be built
+        result = db.session.execute(
+            text(
+                "DELETE FROM step WHERE id NOT IN "
+                "(SELECT MIN(id) FROM step GROUP BY user_id, date)"
+            )
+        )
+        db.session.commit()
+        if result.rowcount:
+            app.logger.warning("Removed %d duplicate step entries", result.rowcount)
+        # create_all() skips tables that already exist, so add any missing
+        # indexes to databases created before they were declared
+        for index in Step.__table__.indexes:
+            index.create(db.engine, checkfirst=True)
+        # Superseded by the unique uq_step_user_date index
+        db.session.execute(text("DROP INDEX IF EXISTS ix_step_user_date"))
+        db.session.commit()
     app.run(host="0.0.0.0", port=5000)